@@ -1,16 +1,76 @@
-from fastapi import FastAPI, HTTPException
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Annotated, Optional
+from fastapi import Body, FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from dotenv import load_dotenv
+import json
 import os
-from schamas import CustomerMessageRequest, MainResponse
-from services.gbt_service import CustomerSupportAIService
+from schamas import (
+    BatchStatusResponse,
+    CustomerMessageRequest,
+    MainResponse,
+    MessageClassification,
+)
+from services.batch_service import (
+    MAX_BATCH_REQUESTS,
+    BatchStore,
+    CustomerSupportBatchService,
+)
+from services.gbt_service import (
+    CustomerSupportAIService,
+    close_openai_client,
+    get_openai_client,
+    response_format_tokens,
+)
+from services.ratelimit import load_encodings
+from services.semantic_cache import (
+    EMBEDDING_MODEL,
+    EmbeddingCache,
+    SemanticCache,
+    claim_writer,
+)
 
 load_dotenv()
 
+SEMANTIC_CACHE_PATH = os.getenv("SEMANTIC_CACHE_PATH", "semantic_cache.npz")
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "embeddings.sqlite3")
+BATCH_STORE_PATH = os.getenv("BATCH_STORE_PATH", "batches.sqlite3")
+MAX_MESSAGES_PER_REQUEST = int(os.getenv("MAX_MESSAGES_PER_REQUEST", "100"))
+semantic_cache = SemanticCache.load(SEMANTIC_CACHE_PATH)
+embedding_cache = EmbeddingCache(EMBEDDING_CACHE_PATH)
+batch_store = BatchStore(BATCH_STORE_PATH)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Create the OpenAI client at startup, inside this worker's process, so
+    # every worker gets its own connection pool
+    get_openai_client()
+    # Load token encodings before serving, since tiktoken may download them
+    await asyncio.to_thread(
+        load_encodings, [CustomerSupportAIService.MODEL, EMBEDDING_MODEL]
+    )
+    response_format_tokens()
+    # Only one worker saves the semantic cache, since they share its file
+    saves_semantic_cache = claim_writer(SEMANTIC_CACHE_PATH)
+    app.state.openai_ready = True
+    yield
+    app.state.openai_ready = False
+    await close_openai_client()
+    # Persist the semantic cache so it survives restarts
+    if saves_semantic_cache:
+        semantic_cache.save(SEMANTIC_CACHE_PATH)
+    embedding_cache.close()
+    batch_store.close()
+
 
 app = FastAPI(
     title="Customer Support AI Service",
     description="AI-powered customer support message classification and response generation",
     version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
 )
 
 
@@ -20,18 +80,13 @@ def read_root():
 
 
 @app.post("/process-customer-message", response_model=MainResponse)
-def process_customer_message(request: CustomerMessageRequest):
+async def process_customer_message(request: CustomerMessageRequest):
     try:
-        # Check if OpenAI API key exists
-        OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-        if not OPENAI_API_KEY:
-            raise ValueError(
-                "OPENAI_API_KEY environment variable is required. Please add it to your .env file."
-            )
-
         # Initialize AI service and process the message
-        ai_service = CustomerSupportAIService()
-        response = ai_service.classify_and_generate_response(request)
+        ai_service = CustomerSupportAIService(
+            semantic_cache=semantic_cache, embedding_cache=embedding_cache
+        )
+        response = await ai_service.classify_and_generate_response(request)
 
         return response
 
@@ -39,6 +94,91 @@ def process_customer_message(request: CustomerMessageRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/process-customer-message/stream")
+async def stream_customer_message(request: CustomerMessageRequest):
+    """
+    Stream a `classification` event as soon as the message type is known,
+    followed by a `response` event with the full response, as Server-Sent Events
+    """
+    ai_service = CustomerSupportAIService(
+        semantic_cache=semantic_cache, embedding_cache=embedding_cache
+    )
+
+    async def event_stream():
+        try:
+            async for item in ai_service.stream_classify_and_generate_response(request):
+                event = (
+                    "classification"
+                    if isinstance(item, MessageClassification)
+                    else "response"
+                )
+                yield f"event: {event}\ndata: {item.model_dump_json()}\n\n"
+        except Exception as e:
+            yield f"event: error\ndata: {json.dumps({'detail': str(e)})}\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        # Ask nginx not to buffer the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.post("/process-customer-messages", response_model=list[Optional[MainResponse]])
+async def process_customer_messages(
+    requests: Annotated[
+        list[CustomerMessageRequest], Body(max_length=MAX_MESSAGES_PER_REQUEST)
+    ],
+):
+    """
+    Process several messages at once, with null in place of any that failed
+    """
+    try:
+        # Process all messages concurrently, bounded by the service's limit
+        ai_service = CustomerSupportAIService(
+            semantic_cache=semantic_cache, embedding_cache=embedding_cache
+        )
+        responses = await ai_service.process_many(requests)
+
+        return responses
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/batch", response_model=BatchStatusResponse)
+async def submit_batch(
+    requests: Annotated[
+        list[CustomerMessageRequest],
+        Body(min_length=1, max_length=MAX_BATCH_REQUESTS),
+    ],
+):
+    """
+    Submit messages to the OpenAI Batch API for non-interactive processing
+    """
+    try:
+        batch_service = CustomerSupportBatchService(batch_store)
+        return await batch_service.submit_batch(requests)
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/batch/{batch_id}", response_model=BatchStatusResponse)
+async def get_batch(batch_id: str):
+    """
+    Return the status of a submitted batch, with its results once completed
+    """
+    try:
+        batch_service = CustomerSupportBatchService(batch_store)
+        return await batch_service.get_batch(batch_id)
+
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Unknown batch: {batch_id}")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @app.get("/health")
 def health_check():
     """
@@ -47,5 +187,5 @@ def health_check():
     return {
         "status": "healthy",
         "message": "Application is running successfully",
-        "openai_key_configured": bool(os.getenv("OPENAI_API_KEY")),
+        "openai_ready": getattr(app.state, "openai_ready", False),
     }
@@ -1,6 +1,6 @@
 from enum import Enum
-from typing import Union
-from pydantic import BaseModel, Field
+from typing import Annotated, Literal, Optional, Union
+from pydantic import BaseModel, ConfigDict, Field
 
 
 class CustomerMessageRequest(BaseModel):
@@ -9,8 +9,14 @@ class CustomerMessageRequest(BaseModel):
     product: str = Field(..., description="The product the customer is interested in")
 
 
+class ResponseModel(BaseModel):
+    # Response objects are never modified after they are built, and may be
+    # shared (fallbacks, semantic cache entries), so make that explicit
+    model_config = ConfigDict(frozen=True, extra="forbid")
+
+
 # Response schema
-class TicketModel(BaseModel):
+class TicketModel(ResponseModel):
     id: str = Field(..., description="The ticket ID")
     title: str = Field(..., description="The title of the issue")
     severity: str = Field(..., description="The severity of the issue")
@@ -24,11 +30,12 @@ class TicketModel(BaseModel):
     assigned_team: str = Field(..., description="The team assigned to the ticket")
 
 
-class TicketResponse(BaseModel):
+class TicketResponse(ResponseModel):
+    kind: Literal["ticket"] = "ticket"
     ticket: TicketModel
 
 
-class ProductRequirementModel(BaseModel):
+class ProductRequirementModel(ResponseModel):
     id: str = Field(..., description="The feature requirement ID")
     title: str = Field(..., description="The title of the feature")
     description: str = Field(..., description="Description of the feature")
@@ -45,7 +52,8 @@ class ProductRequirementModel(BaseModel):
     status: str = Field(..., description="Current status of the feature requirement")
 
 
-class ProductRequirementResponse(BaseModel):
+class ProductRequirementResponse(ResponseModel):
+    kind: Literal["product_requirement"] = "product_requirement"
     product_requirement: ProductRequirementModel
 
 
@@ -56,12 +64,13 @@ class InquiryCategory(str, Enum):
     other = "Other"
 
 
-class SuggestedResource(BaseModel):
+class SuggestedResource(ResponseModel):
     title: str = Field(..., description="The name of the suggested resource")
     url: str = Field(..., description="The URL of the suggested resource")
 
 
-class GeneralInquiryResponse(BaseModel):
+class GeneralInquiryResponse(ResponseModel):
+    kind: Literal["general_inquiry"] = "general_inquiry"
     inquiry_category: InquiryCategory = Field(
         ..., description="The category of the inquiry"
     )
@@ -79,7 +88,68 @@ class MessageType(str, Enum):
     general_inquiry = "general_inquiry"
 
 
-class MainResponse(BaseModel):
+# Model output schema
+#
+# Structured outputs only accept `anyOf` unions, so each variant carries a
+# `message_type` literal instead of using a pydantic discriminator (`oneOf`).
+class TicketDraft(ResponseModel):
+    message_type: Literal[MessageType.bug_report]
+    title: str = Field(..., description="Concise issue title")
+    severity: str = Field(
+        ..., description='One of "Low", "Medium", "High" or "Critical"'
+    )
+    affected_components: list[str] = Field(
+        ..., description="List of affected components"
+    )
+    reproduction_steps: list[str] = Field(
+        ..., description="List of steps to reproduce the issue"
+    )
+    priority: str = Field(..., description='One of "Low", "Medium", "High" or "Urgent"')
+    assigned_team: str = Field(..., description="Appropriate team name")
+
+
+class ProductRequirementDraft(ResponseModel):
+    message_type: Literal[MessageType.feature_request]
+    title: str = Field(..., description="Concise feature title")
+    description: str = Field(..., description="Detailed feature description")
+    user_story: str = Field(
+        ...,
+        description='User story in the form "As a [user], I want [feature] so that [benefit]"',
+    )
+    business_value: str = Field(
+        ..., description='"High", "Medium" or "Low" with a brief rationale'
+    )
+    complexity_estimate: str = Field(
+        ..., description='One of "Low", "Medium" or "High"'
+    )
+    affected_components: list[str] = Field(
+        ..., description="List of components that would be affected"
+    )
+
+
+class GeneralInquiryDraft(ResponseModel):
+    message_type: Literal[MessageType.general_inquiry]
+    inquiry_category: InquiryCategory = Field(
+        ..., description="The category of the inquiry"
+    )
+    requires_human_review: bool = Field(
+        ..., description="Whether the inquiry requires human review"
+    )
+    suggested_resources: list[SuggestedResource] = Field(
+        ..., description="1-3 relevant resources"
+    )
+
+
+class ClassifiedMessage(ResponseModel):
+    confidence_score: float = Field(
+        ..., description="Confidence score for the classification, 0.0 to 1.0"
+    )
+    response_data: Union[TicketDraft, ProductRequirementDraft, GeneralInquiryDraft] = (
+        Field(..., description="Structured data for the detected message type")
+    )
+
+
+class MessageClassification(ResponseModel):
     message_type: MessageType = Field(
         ...,
         description="Type of the message: bug_report, feature_request, or general_inquiry",
@@ -87,11 +157,34 @@ class MainResponse(BaseModel):
     confidence_score: float = Field(
         ..., description="Confidence score for the classification"
     )
-    response_data: Union[
-        TicketResponse, ProductRequirementResponse, GeneralInquiryResponse
+
+
+class MainResponse(ResponseModel):
+    message_type: MessageType = Field(
+        ...,
+        description="Type of the message: bug_report, feature_request, or general_inquiry",
+    )
+    confidence_score: float = Field(
+        ..., description="Confidence score for the classification"
+    )
+    response_data: Annotated[
+        Union[TicketResponse, ProductRequirementResponse, GeneralInquiryResponse],
+        Field(discriminator="kind"),
     ] = Field(
         ..., description="The response data object, structure depends on message_type"
     )
     customer_response: str = Field(
         ..., description="Plain text response to the customer"
     )
+
+
+class BatchStatusResponse(ResponseModel):
+    id: str = Field(..., description="The OpenAI batch ID")
+    status: str = Field(..., description="The OpenAI batch status")
+    total: int = Field(0, description="Number of messages in the batch")
+    completed: int = Field(0, description="Number of messages processed")
+    failed: int = Field(0, description="Number of messages that failed")
+    results: Optional[list[Optional[MainResponse]]] = Field(
+        None,
+        description="Responses in submission order once the batch has completed; failed messages are null",
+    )
@@ -0,0 +1,191 @@
+import json
+from typing import Optional
+from openai.lib._parsing._completions import type_to_response_format_param
+from openai.types import Batch
+from pydantic import TypeAdapter, ValidationError
+from schamas import (
+    BatchStatusResponse,
+    ClassifiedMessage,
+    CustomerMessageRequest,
+    MainResponse,
+)
+from services.database import Database
+from services.gbt_service import CustomerSupportAIService, get_openai_client
+
+# Largest number of requests the Batch API accepts in one batch
+MAX_BATCH_REQUESTS = 50_000
+# Batches that will not change any more. Expired and cancelled ones can still
+# have output for the requests that finished.
+FINAL_STATUSES = {"completed", "expired", "cancelled", "failed"}
+
+_requests_adapter = TypeAdapter(list[CustomerMessageRequest])
+_results_adapter = TypeAdapter(list[Optional[MainResponse]])
+
+
+class BatchStore:
+    """
+    Submitted requests by batch ID, needed to build customer responses once the
+    batch completes, and the responses built for it. Kept in SQLite so any
+    worker can serve a poll.
+    """
+
+    def __init__(self, path: str):
+        self._db = Database(
+            path,
+            "CREATE TABLE IF NOT EXISTS batches "
+            "(id TEXT PRIMARY KEY, requests TEXT NOT NULL, results TEXT)",
+        )
+
+    async def add(self, batch_id: str, requests: list[CustomerMessageRequest]) -> None:
+        await self._db.execute(
+            "INSERT INTO batches (id, requests) VALUES (?, ?)",
+            (batch_id, _requests_adapter.dump_json(requests).decode()),
+        )
+
+    async def get(
+        self, batch_id: str
+    ) -> Optional[
+        tuple[list[CustomerMessageRequest], Optional[list[Optional[MainResponse]]]]
+    ]:
+        """
+        Return the batch's requests and its stored results, if any
+        """
+        row = await self._db.execute(
+            "SELECT requests, results FROM batches WHERE id = ?",
+            (batch_id,),
+        )
+        if row is None:
+            return None
+        requests, results = row
+        return _requests_adapter.validate_json(requests), (
+            None if results is None else _results_adapter.validate_json(results)
+        )
+
+    async def set_results(
+        self, batch_id: str, results: list[Optional[MainResponse]]
+    ) -> list[Optional[MainResponse]]:
+        """
+        Store the batch's results unless another poll already did, and return
+        the stored ones, so every poll reports the same ticket IDs
+        """
+        await self._db.execute(
+            "UPDATE batches SET results = ? WHERE id = ? AND results IS NULL",
+            (_results_adapter.dump_json(results).decode(), batch_id),
+        )
+        _, stored = await self.get(batch_id)
+        return stored
+
+    def close(self) -> None:
+        self._db.close()
+
+
+class CustomerSupportBatchService:
+    def __init__(self, store: BatchStore):
+        self.client = get_openai_client()
+        self.store = store
+        self.ai_service = CustomerSupportAIService()
+
+    async def submit_batch(
+        self, requests: list[CustomerMessageRequest]
+    ) -> BatchStatusResponse:
+        """
+        Upload the messages as a JSONL batch input file and start an OpenAI
+        batch job for them
+        """
+        response_format = type_to_response_format_param(ClassifiedMessage)
+        lines = [
+            json.dumps(
+                {
+                    "custom_id": str(index),
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": {
+                        **self.ai_service.build_completion_params(request),
+                        "response_format": response_format,
+                    },
+                }
+            )
+            for index, request in enumerate(requests)
+        ]
+
+        input_file = await self.client.files.create(
+            file=("customer_messages.jsonl", "\n".join(lines).encode()),
+            purpose="batch",
+        )
+        batch = await self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+        await self.store.add(batch.id, requests)
+
+        return self._build_status(batch)
+
+    async def get_batch(self, batch_id: str) -> BatchStatusResponse:
+        """
+        Return the batch status, with the parsed responses once it has finished
+        """
+        entry = await self.store.get(batch_id)
+        if entry is None:
+            raise KeyError(batch_id)
+        requests, results = entry
+
+        batch = await self.client.batches.retrieve(batch_id)
+
+        # Results are built once, since building them assigns new ticket IDs
+        if results is None and batch.status in FINAL_STATUSES:
+            results = await self._download_results(batch, requests)
+            results = await self.store.set_results(batch_id, results)
+
+        return self._build_status(batch, results)
+
+    async def _download_results(
+        self, batch: Batch, requests: list[CustomerMessageRequest]
+    ) -> list[Optional[MainResponse]]:
+        """
+        Parse the batch output file into responses ordered like the requests
+        """
+        results: list[Optional[MainResponse]] = [None] * len(requests)
+        if not batch.output_file_id:
+            return results
+
+        output = await self.client.files.content(batch.output_file_id)
+        for line in output.text.splitlines():
+            if not line.strip():
+                continue
+
+            item = json.loads(line)
+            response = item.get("response")
+            if not response or response["status_code"] != 200:
+                continue
+
+            index = int(item["custom_id"])
+            choice = response["body"]["choices"][0]
+            message = choice["message"]
+            result = None
+            if not message.get("refusal"):
+                # Output cut short, e.g. by the token limit, stays None
+                if choice.get("finish_reason") != "stop":
+                    continue
+                try:
+                    result = ClassifiedMessage.model_validate_json(message["content"])
+                except ValidationError:
+                    continue
+            results[index] = self.ai_service.build_main_response(
+                requests[index], result
+            )
+
+        return results
+
+    def _build_status(
+        self, batch: Batch, results: Optional[list[Optional[MainResponse]]] = None
+    ) -> BatchStatusResponse:
+        counts = batch.request_counts
+        return BatchStatusResponse(
+            id=batch.id,
+            status=batch.status,
+            total=counts.total if counts else 0,
+            completed=counts.completed if counts else 0,
+            failed=counts.failed if counts else 0,
+            results=results,
+        )
@@ -0,0 +1,35 @@
+import asyncio
+import sqlite3
+import threading
+from typing import Optional
+
+
+class Database:
+    """
+    SQLite database queried off the event loop, since another worker may hold
+    its write lock. The connection is shared by the threads running queries,
+    one query at a time.
+    """
+
+    def __init__(self, path: str, schema: str):
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        # WAL lets the server's workers read while one of them writes
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(schema)
+
+    async def execute(self, sql: str, params: tuple = ()) -> Optional[tuple]:
+        """
+        Run and commit one statement in a worker thread, returning its first row
+        """
+        return await asyncio.to_thread(self._execute, sql, params)
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def _execute(self, sql: str, params: tuple) -> Optional[tuple]:
+        with self._lock:
+            row = self._connection.execute(sql, params).fetchone()
+            self._connection.commit()
+            return row
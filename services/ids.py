@@ -0,0 +1,58 @@
+import time
+from services.workers import worker_count, worker_slot
+
+# Snowflake layout in 63 bits: milliseconds since EPOCH_MS, a worker ID and a
+# per-millisecond sequence, so IDs fit a signed 64-bit column
+EPOCH_MS = 1735689600000  # 2025-01-01T00:00:00Z
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+
+
+class IdGenerator:
+    """
+    Time-ordered, unique integer IDs without a shared counter, given a worker
+    ID that no other running process uses
+    """
+
+    def __init__(self, worker_id: int):
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f"worker_id must be between 0 and {MAX_WORKER_ID}")
+        self.worker_id = worker_id
+        self._last_ms = -1
+        self._sequence = 0
+
+    def next_id(self) -> int:
+        now_ms = self._now_ms()
+        if now_ms > self._last_ms:
+            self._last_ms = now_ms
+            self._sequence = 0
+        else:
+            # Same millisecond, or the clock moved back: continue from the last
+            # one, borrowing the next millisecond once its sequence runs out
+            # instead of waiting for the clock
+            self._sequence = (self._sequence + 1) % (1 << SEQUENCE_BITS)
+            if self._sequence == 0:
+                self._last_ms += 1
+
+        return (
+            (self._last_ms - EPOCH_MS) << (WORKER_BITS + SEQUENCE_BITS)
+            | self.worker_id << SEQUENCE_BITS
+            | self._sequence
+        )
+
+    def _now_ms(self) -> int:
+        return time.time_ns() // 1_000_000
+
+
+def claim_worker_id(node_id: int) -> int:
+    """
+    Return a worker ID for this process: its node's block of worker IDs,
+    offset by its worker slot on the host
+    """
+    worker_id = node_id * worker_count() + worker_slot()
+    if not 0 <= worker_id <= MAX_WORKER_ID:
+        raise ValueError(
+            f"NODE_ID * WEB_CONCURRENCY must stay below {MAX_WORKER_ID + 1}"
+        )
+    return worker_id
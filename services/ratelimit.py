@@ -0,0 +1,169 @@
+import asyncio
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from functools import cache
+from typing import AsyncIterator
+import tiktoken
+from openai import RateLimitError
+from services.workers import worker_share
+
+# Budget assumed for the structured output of a completion
+ESTIMATED_COMPLETION_TOKENS = 300
+# Tokens the chat format adds around each message
+TOKENS_PER_MESSAGE = 3
+# Rough count for models whose encoding could not be loaded
+CHARACTERS_PER_TOKEN = 4
+
+# AIMD adjustment of the refill rate: halve it on a 429, then recover
+# additively with each successful request
+RATE_DECREASE_FACTOR = 0.5
+RATE_INCREASE_STEP = 0.05
+MIN_RATE_SCALE = 0.1
+
+logger = logging.getLogger(__name__)
+
+# Encodings by model, populated at startup by load_encodings
+_encodings: dict[str, tiktoken.Encoding] = {}
+
+
+class RateLimiter:
+    """
+    Proactive requests-per-minute and tokens-per-minute throttle, using the
+    dual token bucket design of the OpenAI cookbook's parallel request
+    processor, so requests wait for capacity instead of hitting 429s
+    """
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.rate_scale = 1.0
+        self._available_requests = requests_per_minute
+        self._available_tokens = tokens_per_minute
+        self._last_update = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    @asynccontextmanager
+    async def reserve(self, estimated_tokens: int) -> AsyncIterator[None]:
+        """
+        Wait until there is capacity for one request of `estimated_tokens`,
+        then adjust the refill rate based on whether it was rate limited
+        """
+        await self._acquire(estimated_tokens)
+        try:
+            yield
+        except RateLimitError as e:
+            # Running out of quota says nothing about the request rate
+            if not is_quota_exhausted(e):
+                self.rate_scale = max(
+                    MIN_RATE_SCALE, self.rate_scale * RATE_DECREASE_FACTOR
+                )
+            raise
+        self.rate_scale = min(1.0, self.rate_scale + RATE_INCREASE_STEP)
+
+    async def _acquire(self, tokens: int) -> None:
+        # A request larger than the whole bucket would never fit
+        tokens = min(tokens, self.tokens_per_minute)
+
+        # Waiters queue on the lock, so capacity is handed out in order
+        async with self._lock:
+            while True:
+                self._refill()
+                missing_requests = 1 - self._available_requests
+                missing_tokens = tokens - self._available_tokens
+                if missing_requests <= 0 and missing_tokens <= 0:
+                    self._available_requests -= 1
+                    self._available_tokens -= tokens
+                    return
+
+                await asyncio.sleep(
+                    max(
+                        missing_requests / self._per_second(self.requests_per_minute),
+                        missing_tokens / self._per_second(self.tokens_per_minute),
+                    )
+                )
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self._last_update
+        self._last_update = now
+
+        self._available_requests = min(
+            self.requests_per_minute,
+            self._available_requests
+            + elapsed * self._per_second(self.requests_per_minute),
+        )
+        self._available_tokens = min(
+            self.tokens_per_minute,
+            self._available_tokens + elapsed * self._per_second(self.tokens_per_minute),
+        )
+
+    def _per_second(self, per_minute: float) -> float:
+        return per_minute * self.rate_scale / 60
+
+
+def is_quota_exhausted(error: RateLimitError) -> bool:
+    """
+    Whether a 429 means the account is out of quota, which retrying won't fix
+    """
+    return error.code == "insufficient_quota"
+
+
+@cache
+def get_rate_limiter(model: str) -> RateLimiter:
+    """
+    Return the process-wide limiter for a model, since OpenAI enforces
+    limits per model. The configured limits are for the whole server.
+    """
+    return RateLimiter(
+        requests_per_minute=worker_share(
+            float(os.getenv("OPENAI_REQUESTS_PER_MINUTE", "500"))
+        ),
+        tokens_per_minute=worker_share(
+            float(os.getenv("OPENAI_TOKENS_PER_MINUTE", "200000"))
+        ),
+    )
+
+
+def load_encodings(models: list[str]) -> None:
+    """
+    Load the tiktoken encodings of `models`. tiktoken downloads an encoding
+    the first time it is used unless it is in TIKTOKEN_CACHE_DIR, so this
+    runs at startup rather than on a request. Models whose encoding cannot
+    be loaded fall back to a character-based estimate.
+    """
+    for model in models:
+        try:
+            _encodings[model] = tiktoken.encoding_for_model(model)
+        except Exception:
+            logger.warning(
+                "Could not load the tiktoken encoding for %s, estimating tokens "
+                "from message length",
+                model,
+                exc_info=True,
+            )
+
+
+def count_tokens(model: str, text: str) -> int:
+    encoding = _encodings.get(model)
+    if encoding is None:
+        return len(text) // CHARACTERS_PER_TOKEN
+    return len(encoding.encode(text))
+
+
+def estimate_chat_tokens(
+    model: str,
+    messages: list[dict],
+    completion_tokens: int = ESTIMATED_COMPLETION_TOKENS,
+    schema_tokens: int = 0,
+) -> int:
+    """
+    Estimate the tokens a chat completion counts against the TPM limit.
+    `schema_tokens` covers a response_format schema, billed as prompt tokens.
+    """
+    prompt_tokens = sum(
+        TOKENS_PER_MESSAGE + count_tokens(model, message["content"])
+        for message in messages
+    )
+    return prompt_tokens + schema_tokens + completion_tokens
@@ -0,0 +1,236 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+from collections import OrderedDict
+from typing import Optional
+import faiss
+import numpy as np
+from schamas import ClassifiedMessage
+from services.database import Database
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIMENSIONS = 1536
+SIMILARITY_THRESHOLD = 0.92
+EMBEDDING_CACHE_SIZE = 10_000
+SEMANTIC_CACHE_SIZE = 10_000
+SEMANTIC_CACHE_PRODUCT_SIZE = 1_000
+
+logger = logging.getLogger(__name__)
+
+# Lock files held open by this process, by cache path
+_writer_locks = {}
+
+
+def claim_writer(path: str) -> bool:
+    """
+    Try to become the only process that saves the cache at `path`, for as
+    long as this process runs, so the server's workers do not all save it
+    """
+    lock_file = open(f"{path}.lock", "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    _writer_locks[path] = lock_file
+    return True
+
+
+class EmbeddingCache:
+    """
+    Exact-match cache of embeddings keyed by a hash of the model and text, held
+    in an in-memory LRU and optionally persisted to SQLite
+    """
+
+    def __init__(self, path: Optional[str] = None, maxsize: int = EMBEDDING_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._db = None
+        if path is not None:
+            self._db = Database(
+                path,
+                "CREATE TABLE IF NOT EXISTS embeddings "
+                "(hash TEXT PRIMARY KEY, embedding BLOB NOT NULL)",
+            )
+
+    async def get(self, text: str) -> Optional[np.ndarray]:
+        key = self._key(text)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+        if self._db is not None:
+            # A failed read is treated as a miss
+            try:
+                row = await self._db.execute(
+                    "SELECT embedding FROM embeddings WHERE hash = ?", (key,)
+                )
+            except sqlite3.Error:
+                logger.warning("Embedding cache read failed", exc_info=True)
+                row = None
+            if row is not None:
+                embedding = np.frombuffer(row[0], dtype=np.float32)
+                self._remember(key, embedding)
+                return embedding
+
+        return None
+
+    async def set(self, text: str, embedding: np.ndarray) -> None:
+        key = self._key(text)
+        embedding = np.asarray(embedding, dtype=np.float32)
+        self._remember(key, embedding)
+
+        if self._db is not None:
+            # The embedding is already paid for, so losing the write is fine
+            try:
+                await self._db.execute(
+                    "INSERT OR REPLACE INTO embeddings (hash, embedding) "
+                    "VALUES (?, ?)",
+                    (key, embedding.tobytes()),
+                )
+            except sqlite3.Error:
+                logger.warning("Embedding cache write failed", exc_info=True)
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _key(self, text: str) -> str:
+        return hashlib.blake2b(
+            f"{EMBEDDING_MODEL}:{text}".encode(), digest_size=16
+        ).hexdigest()
+
+    def _remember(self, key: str, embedding: np.ndarray) -> None:
+        self._entries[key] = embedding
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+
+class SemanticCache:
+    """
+    In-memory index of message embeddings and the model output generated for
+    each message, so semantically equivalent messages can skip the model call.
+    Each product has its own index, since the output depends on the product.
+    Products are supplied by clients, so both the entries per product and the
+    total are capped, evicting the oldest entries first.
+    """
+
+    def __init__(
+        self,
+        dimensions: int = EMBEDDING_DIMENSIONS,
+        threshold: float = SIMILARITY_THRESHOLD,
+        maxsize: int = SEMANTIC_CACHE_SIZE,
+        product_maxsize: int = SEMANTIC_CACHE_PRODUCT_SIZE,
+    ):
+        self.dimensions = dimensions
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.product_maxsize = product_maxsize
+        self.size = 0
+        # Inner product over normalized vectors is cosine similarity. Products
+        # are kept in least recently used order.
+        self.indexes: OrderedDict[str, faiss.IndexFlatIP] = OrderedDict()
+        self.results: dict[str, list[ClassifiedMessage]] = {}
+
+    def search(
+        self, product: str, embedding: np.ndarray
+    ) -> Optional[ClassifiedMessage]:
+        """
+        Return the cached output for the closest message about the same
+        product, if it is similar enough
+        """
+        if not self.results.get(product):
+            return None
+
+        similarities, indices = self.indexes[product].search(
+            self._normalize(embedding), 1
+        )
+        if similarities[0][0] < self.threshold:
+            return None
+        self.indexes.move_to_end(product)
+        return self.results[product][indices[0][0]]
+
+    def add(
+        self, product: str, embedding: np.ndarray, result: ClassifiedMessage
+    ) -> None:
+        if product not in self.indexes:
+            self.indexes[product] = faiss.IndexFlatIP(self.dimensions)
+            self.results[product] = []
+        self.indexes.move_to_end(product)
+        self.indexes[product].add(self._normalize(embedding))
+        self.results[product].append(result)
+        self.size += 1
+
+        if len(self.results[product]) > self.product_maxsize:
+            self._evict_oldest(product)
+        while self.size > self.maxsize:
+            self._evict_oldest(next(iter(self.indexes)))
+
+    def save(self, path: str) -> None:
+        """
+        Write the vectors of every product and the cached outputs, with their
+        product, to one .npz file at `path`. The file is written next to it
+        and then moved into place, so a reader never sees a partial cache.
+        """
+        vectors = [np.empty((0, self.dimensions), dtype=np.float32)]
+        items = []
+        for product, index in self.indexes.items():
+            vectors.append(index.reconstruct_n(0, index.ntotal))
+            items.extend(
+                {"product": product, "result": result.model_dump(mode="json")}
+                for result in self.results[product]
+            )
+
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            np.savez(f, vectors=np.concatenate(vectors), items=json.dumps(items))
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "SemanticCache":
+        """
+        Load a cache saved with `save`, or return an empty one if there is none
+        or it cannot be read
+        """
+        cache = cls()
+        if not os.path.exists(path):
+            return cache
+
+        try:
+            with np.load(path) as data:
+                vectors = data["vectors"]
+                items = json.loads(data["items"].item())
+            for vector, item in zip(vectors, items, strict=True):
+                cache.add(
+                    item["product"],
+                    vector,
+                    ClassifiedMessage.model_validate(item["result"]),
+                )
+        except Exception:
+            logger.warning(
+                "Could not load the semantic cache from %s, starting empty",
+                path,
+                exc_info=True,
+            )
+            return cls()
+        return cache
+
+    def _evict_oldest(self, product: str) -> None:
+        # Removing from a flat index shifts later IDs down, like the list
+        self.indexes[product].remove_ids(np.array([0], dtype=np.int64))
+        self.results[product].pop(0)
+        self.size -= 1
+        if not self.results[product]:
+            del self.indexes[product]
+            del self.results[product]
+
+    def _normalize(self, embedding: np.ndarray) -> np.ndarray:
+        # Copy, since normalize_L2 works in place and embeddings may be cached
+        vector = np.array(embedding, dtype=np.float32).reshape(1, -1)
+        faiss.normalize_L2(vector)
+        return vector
@@ -0,0 +1,56 @@
+import fcntl
+import os
+import tempfile
+from functools import cache
+
+# Lock files held open by this process, claiming its worker slot
+_slot_locks = []
+
+
+def worker_count() -> int:
+    """
+    Number of server worker processes, as exported by start.sh
+    """
+    return max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+
+
+@cache
+def worker_slot() -> int:
+    """
+    Index of this process among the host's workers. The slot stays claimed
+    while its lock file is open, so a restarted worker takes over the slot of
+    the one it replaces.
+    """
+    workers = worker_count()
+    if workers == 1:
+        return 0
+
+    for index in range(workers):
+        path = os.path.join(tempfile.gettempdir(), f"support-ai-worker-{index}.lock")
+        lock_file = open(path, "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            continue
+        _slot_locks.append(lock_file)
+        return index
+
+    raise RuntimeError(f"All {workers} worker slots are taken")
+
+
+def worker_share(total: float) -> float:
+    """
+    Split a budget for the whole server evenly across its worker processes,
+    which do not share limiters
+    """
+    return total / worker_count()
+
+
+def worker_share_count(total: int) -> int:
+    """
+    Split a whole-number budget across the worker processes so that their
+    shares add up to exactly `total`
+    """
+    workers = worker_count()
+    return total // workers + (worker_slot() < total % workers)
@@ -0,0 +1,22 @@
+#!/bin/sh
+# Production server: one worker per core, uvloop event loop, httptools
+# parser and no per-request access log
+
+# Exported so workers can split the OpenAI rate limits between them
+export WEB_CONCURRENCY="${WEB_CONCURRENCY:-$(nproc)}"
+
+# Every worker needs at least one of the OPENAI_MAX_CONCURRENCY request slots
+max_concurrency="${OPENAI_MAX_CONCURRENCY:-8}"
+if [ "$WEB_CONCURRENCY" -gt "$max_concurrency" ]; then
+    echo "WEB_CONCURRENCY=$WEB_CONCURRENCY exceeds OPENAI_MAX_CONCURRENCY=$max_concurrency, running $max_concurrency workers" >&2
+    WEB_CONCURRENCY="$max_concurrency"
+fi
+
+exec uvicorn main:app \
+    --host 0.0.0.0 \
+    --port "${PORT:-8000}" \
+    --workers "$WEB_CONCURRENCY" \
+    --loop uvloop \
+    --http httptools \
+    --no-access-log \
+    --proxy-headers